@@ -1,10 +1,15 @@
 import os
+import asyncio
+from collections import OrderedDict
+from typing import Any, List, Optional
+import httpx
 from dotenv import load_dotenv
 from neo4j import GraphDatabase
 from neo4j_graphrag.retrievers import VectorRetriever
 from neo4j_graphrag.embeddings import OllamaEmbeddings
 from neo4j_graphrag.generation import GraphRAG
-from neo4j_graphrag.llm import LLMInterface
+from neo4j_graphrag.llm import LLMInterfaceV2, LLMResponse
+from neo4j_graphrag.types import LLMMessage
 
 # Load environment variables
 load_dotenv()
@@ -12,16 +17,51 @@ load_dotenv()
 NEO4J_URI = os.getenv("NEO4J_URI")
 NEO4J_USERNAME = os.getenv("NEO4J_USERNAME")
 NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
+NEO4J_DATABASE = os.getenv("NEO4J_DATABASE", "neo4j")
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 
 if not all([NEO4J_URI, NEO4J_USERNAME, NEO4J_PASSWORD]):
     print("Error: Missing environment variables.")
     exit(1)
 
 # Connect to Neo4j
-driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USERNAME, NEO4J_PASSWORD))
+# The driver pools Bolt connections, so repeated queries skip the TCP/HELLO handshake
+driver = GraphDatabase.driver(
+    NEO4J_URI,
+    auth=(NEO4J_USERNAME, NEO4J_PASSWORD),
+    max_connection_pool_size=32,
+    connection_acquisition_timeout=60,
+    connection_timeout=30,
+    keep_alive=True,
+)
 
 # Define Embeddings
-embedder = OllamaEmbeddings(model="nomic-embed-text-v2-moe:latest")
+class CachedOllamaEmbeddings(OllamaEmbeddings):
+    """OllamaEmbeddings that remembers query vectors, keyed by the normalized question.
+
+    Only the cache key is normalized; the question is embedded exactly as asked,
+    since the documents were embedded with their original casing.
+    """
+
+    def __init__(self, *args: Any, cache_size: int = 1024, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._cache_size = cache_size
+        self._cache: OrderedDict[str, list[float]] = OrderedDict()
+
+    def embed_query(self, text: str, **kwargs: Any) -> list[float]:
+        if kwargs:
+            return super().embed_query(text, **kwargs)
+        key = text.strip().lower()
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        else:
+            self._cache[key] = super().embed_query(text)
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return list(self._cache[key])
+
+# The embedder holds one ollama.Client (and its HTTP connection pool) for its lifetime
+embedder = CachedOllamaEmbeddings(model="nomic-embed-text-v2-moe:latest", host=OLLAMA_BASE_URL)
 
 # Define Retriever
 # We retrieval on StandardDocument nodes using their embeddings
@@ -29,33 +69,50 @@ retriever = VectorRetriever(
     driver,
     index_name="standard_embeddings",
     embedder=embedder,
-    return_properties=["title", "standard_code"]
+    return_properties=["title", "standard_code"],
+    neo4j_database=NEO4J_DATABASE,
 )
 
 # Define LLM
-# Note: neo4j-graphrag might not have a direct 'OllamaLLM' class in all versions, 
-# but usually supports anything matching their interface or via langchain adapter.
-# For simplicity, we can use the OpenAILLM class pointed at localhost if compatible,
-# OR assume there is an OllamaLLM. Let's check imports.
-# Actually, the safest bet is usually to wrap LangChain's ChatOllama if neo4j-graphrag supports LangChain LLMs.
-# Checking docs: neo4j-graphrag often supports LangChain LLMs directly or via a wrapper.
-
-from langchain_ollama import ChatOllama
-
-class LangChainLLM(LLMInterface):
-    def __init__(self, llm):
-        self.llm = llm
-
-    def invoke(self, input: str, **kwargs):
-        # response = self.llm.invoke(input)
-        # return response
-        # Simplify to direct call
-        return self.llm.invoke(input)
-
-    async def ainvoke(self, input: str, **kwargs):
-        return await self.llm.ainvoke(input)
-
-llm = LangChainLLM(ChatOllama(model="llama3.2:latest", temperature=0))
+# Chat requests go straight to Ollama's /api/chat over persistent keep-alive
+# clients, so repeat questions reuse the same connection instead of reconnecting.
+_CLIENT_OPTIONS = {"base_url": OLLAMA_BASE_URL, "timeout": 120, "limits": httpx.Limits(keepalive_expiry=60)}
+_client = httpx.Client(**_CLIENT_OPTIONS)
+
+class OllamaChatLLM(LLMInterfaceV2):
+    """Chat model on Ollama's /api/chat; GraphRAG passes it the full message list."""
+
+    def __init__(self, model_name: str, temperature: float = 0):
+        super().__init__(model_name=model_name, model_params={"temperature": temperature})
+        # Only opened if GraphRAG takes the async path, on the loop that uses it
+        self._async_client: Optional[httpx.AsyncClient] = None
+
+    def _payload(self, input: List[LLMMessage]) -> dict:
+        return {
+            "model": self.model_name,
+            "messages": [dict(message) for message in input],
+            "options": self.model_params,
+            "stream": False,
+        }
+
+    def invoke(self, input: List[LLMMessage], **kwargs) -> LLMResponse:
+        resp = _client.post("/api/chat", json=self._payload(input))
+        resp.raise_for_status()
+        return LLMResponse(content=resp.json()["message"]["content"])
+
+    async def ainvoke(self, input: List[LLMMessage], **kwargs) -> LLMResponse:
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(**_CLIENT_OPTIONS)
+        resp = await self._async_client.post("/api/chat", json=self._payload(input))
+        resp.raise_for_status()
+        return LLMResponse(content=resp.json()["message"]["content"])
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+llm = OllamaChatLLM("llama3.2:latest", temperature=0)
 
 
 # Define GraphRAG
@@ -64,10 +121,16 @@ rag = GraphRAG(
     llm=llm
 )
 
-def query_graph(question: str):
+async def query_graph(question: str):
     print(f"\nQuestion: {question}")
     try:
-        response = rag.search(query_text=question)
+        # neo4j-graphrag 1.22 has no GraphRAG.asearch, so queries currently take
+        # the to_thread path; asearch is used if a later version adds it.
+        asearch = getattr(rag, "asearch", None)
+        if asearch is not None:
+            response = await asearch(query_text=question)
+        else:
+            response = await asyncio.to_thread(rag.search, query_text=question)
         print(f"Answer: {response.answer}")
         
     except Exception as e:
@@ -75,10 +138,34 @@ def query_graph(question: str):
         traceback.print_exc()
         print(f"Error processing query: {e}")
 
+async def interactive_loop():
+    """Answer questions read from stdin, one per line, reusing the same driver and clients."""
+    print("Enter a question per line (Ctrl-D or an empty line to quit).")
+    while True:
+        try:
+            # Plain blocking read: nothing else runs on the loop while waiting, and a
+            # reader thread would keep asyncio.run from exiting on Ctrl-C
+            q = input("> ").strip()
+        except EOFError:
+            break
+        if not q:
+            break
+        await query_graph(q)
+
+async def main(args: list[str]):
+    try:
+        if args:
+            await query_graph(" ".join(args))
+        else:
+            await interactive_loop()
+    finally:
+        # Close the async client on the loop it was opened on
+        await llm.aclose()
+
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) > 1:
-        q = " ".join(sys.argv[1:])
-        query_graph(q)
-    else:
-        print("Usage: python graphrag_app.py 'Your question here'")
+    try:
+        asyncio.run(main(sys.argv[1:]))
+    finally:
+        _client.close()
+        driver.close()
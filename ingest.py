@@ -1,10 +1,15 @@
 import os
 import sqlite3
 import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
+import httpx
+import numpy as np
 from neo4j import GraphDatabase
-from langchain_ollama import OllamaEmbeddings
+from neo4j.exceptions import ClientError
 
 # Load environment variables
 load_dotenv()
@@ -12,6 +17,8 @@ load_dotenv()
 NEO4J_URI = os.getenv("NEO4J_URI")
 NEO4J_USERNAME = os.getenv("NEO4J_USERNAME")
 NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
+# Naming the database skips the home-database lookup on every new session
+NEO4J_DATABASE = os.getenv("NEO4J_DATABASE", "neo4j")
 # OPENAI_API_KEY no longer strictly needed but good to keep if switching back
 
 if not all([NEO4J_URI, NEO4J_USERNAME, NEO4J_PASSWORD]):
@@ -19,151 +26,333 @@ if not all([NEO4J_URI, NEO4J_USERNAME, NEO4J_PASSWORD]):
     exit(1)
 
 # Initialize Neo4j Driver
-driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USERNAME, NEO4J_PASSWORD))
+driver = GraphDatabase.driver(
+    NEO4J_URI,
+    auth=(NEO4J_USERNAME, NEO4J_PASSWORD),
+    connection_timeout=30,
+    keep_alive=True,
+)
 
-# Initialize Embeddings
-embeddings = OllamaEmbeddings(model="nomic-embed-text-v2-moe:latest")
+# Embeddings are requested straight from Ollama's /api/embed endpoint
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+EMBED_MODEL = "nomic-embed-text-v2-moe:latest"
+
+# Number of texts sent to Ollama's /api/embed endpoint per request
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+
+# Number of /api/embed requests allowed in flight at once
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+
+# Number of rows written per UNWIND statement, bounding transaction state memory
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "10000"))
+
+# References to standards inside note text, e.g. "STD 1234"
+_STD_RE = re.compile(r"STD\s?([0-9]+)")
+# Same pattern for note text read as raw bytes from SQLite
+_STD_RE_BYTES = re.compile(_STD_RE.pattern.encode())
+# Numeric part of a standard_code, e.g. "STD 1234" -> 1234
+_STD_NUMBER_RE = re.compile(r"([0-9]+)")
+
+def standard_number(standard_code: Optional[str]) -> Optional[int]:
+    # Stored as an integer so "STD 0412" and "STD 412" normalize to the same key
+    match = _STD_NUMBER_RE.search(standard_code or "")
+    return int(match.group(1)) if match else None
 
 def get_db_connection(db_path: str):
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # Rows come back as plain tuples; fetch_row_batches() turns them into
+    # UNWIND parameter dicts without building an sqlite3.Row per row.
+    return sqlite3.connect(db_path)
+
+def batched(rows, size: int = WRITE_BATCH_SIZE):
+    """Yield successive lists of at most `size` rows."""
+    it = iter(rows)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def fetch_batches(cursor: sqlite3.Cursor, size: int = WRITE_BATCH_SIZE):
+    """Stream a cursor's result set in lists of at most `size` rows."""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+def fetch_row_batches(cursor: sqlite3.Cursor, size: int = WRITE_BATCH_SIZE):
+    """Like fetch_batches(), but yield each row as a dict keyed by column name."""
+    keys = [col[0] for col in cursor.description]
+    for rows in fetch_batches(cursor, size):
+        yield [dict(zip(keys, row)) for row in rows]
+
+async def _embed_batches(texts: List[str]) -> np.ndarray:
+    semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+    async with httpx.AsyncClient(base_url=OLLAMA_BASE_URL, timeout=60) as client:
+        async def embed_one(batch: List[str]) -> np.ndarray:
+            async with semaphore:
+                resp = await client.post("/api/embed", json={"model": EMBED_MODEL, "input": batch})
+                resp.raise_for_status()
+                return np.asarray(resp.json()["embeddings"], dtype=np.float32)
+
+        results = await asyncio.gather(*(
+            embed_one(texts[start:start + EMBED_BATCH_SIZE])
+            for start in range(0, len(texts), EMBED_BATCH_SIZE)
+        ))
+    return np.concatenate(results)
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """Embed `texts` in EMBED_BATCH_SIZE requests, EMBED_CONCURRENCY at a time, preserving order.
+
+    Returns one contiguous (len(texts), dims) float32 matrix.
+    """
+    return asyncio.run(_embed_batches(texts))
 
-def setup_constraints():
+def quantize_int8(vectors: np.ndarray):
+    """Quantize each row to int8 with its own scale, so that vector ~= q * scale.
+
+    Cosine similarity is scale-invariant, so the vector index can rank the int8
+    vectors directly against FP32 query embeddings. The whole batch is quantized
+    in one pass and converted to Python lists once, just before it is sent.
+    """
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+    return quantized.tolist(), scales.tolist()
+
+def write_batch(session, query: str, **params):
+    """Run `query` in its own explicit write transaction and return its result summary."""
+    return session.execute_write(lambda tx: tx.run(query, **params).consume())
+
+def setup_constraints(session):
     print("Setting up constraints locally...")
-    with driver.session() as session:
-        # Constraints ensuring uniqueness
-        session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (c:CADFile) REQUIRE c.file_id IS UNIQUE")
-        session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (s:StandardDocument) REQUIRE s.doc_id IS UNIQUE")
-        session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (sec:Section) REQUIRE sec.section_id IS UNIQUE")
-        
-        # Drop existing index if needed (to handle dimension change)
-        try:
-            session.run("DROP INDEX standard_embeddings IF EXISTS")
-        except Exception as e:
-            print(f"Index drop warning: {e}")
-
-        # Create new index with 768 dimensions for Nomic
-        session.run("CREATE VECTOR INDEX `standard_embeddings` IF NOT EXISTS FOR (s:StandardDocument) ON (s.embedding) OPTIONS {indexConfig: {`vector.dimensions`: 768, `vector.similarity_function`: 'cosine'}}")
-        
-def clear_database():
+    # Constraints ensuring uniqueness
+    session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (c:CADFile) REQUIRE c.file_id IS UNIQUE")
+    session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (s:StandardDocument) REQUIRE s.doc_id IS UNIQUE")
+    session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (sec:Section) REQUIRE sec.section_id IS UNIQUE")
+
+    # Lookup indexes used when linking notes to standards
+    session.run("CREATE INDEX engineering_note_id IF NOT EXISTS FOR (n:EngineeringNote) ON (n.note_id)")
+    session.run("CREATE INDEX standard_number IF NOT EXISTS FOR (s:StandardDocument) ON (s.standard_number)")
+
+def drop_vector_index(session):
+    # Drop the vector index before the delete and ingest so neither maintains it
+    # row by row; finalize_indexes() rebuilds it once all StandardDocuments are written.
+    try:
+        session.run("DROP INDEX standard_embeddings IF EXISTS")
+    except Exception as e:
+        print(f"Index drop warning: {e}")
+
+def finalize_indexes(session):
+    print("Building vector index...")
+    # Create new index with 768 dimensions for Nomic, with explicit HNSW graph
+    # parameters and quantized in-index vectors for cheaper distance computations
+    session.run("""
+        CREATE VECTOR INDEX `standard_embeddings` IF NOT EXISTS
+        FOR (s:StandardDocument) ON (s.embedding)
+        OPTIONS {indexConfig: {
+            `vector.dimensions`: 768,
+            `vector.similarity_function`: 'cosine',
+            `vector.hnsw.m`: 16,
+            `vector.hnsw.ef_construction`: 200,
+            `vector.quantization.enabled`: true
+        }}
+    """)
+    session.run("CALL db.awaitIndex('standard_embeddings', 300)")
+    
+def clear_database(session):
     print("Clearing existing database...")
-    with driver.session() as session:
-        session.run("MATCH (n) DETACH DELETE n")
+    session.run("MATCH (n) DETACH DELETE n")
 
-def ingest_cad_data():
+def ingest_cad_notes(session):
+    # Ingest Engineering Notes
+    conn = get_db_connection('data/harvested_cad.db')
+    notes = conn.execute("SELECT id, file_id, note_type, note_code, note_value FROM cad_engineering_notes")
+    for rows in fetch_row_batches(notes):
+        write_batch(session, """
+            UNWIND $rows AS r
+            MATCH (c:CADFile {file_id: r.file_id})
+            CREATE (n:EngineeringNote {
+                note_id: r.id,
+                note_type: r.note_type,
+                note_number: r.note_code,
+                content: r.note_value
+            })
+            CREATE (c)-[:HAS_NOTE]->(n)
+        """, rows=rows)
+    conn.close()
+
+def ingest_cad_materials(session):
+    # Ingest Material Properties
+    conn = get_db_connection('data/harvested_cad.db')
+    materials = conn.execute("SELECT file_id, material_name, material_standard, density FROM cad_material_properties")
+    for rows in fetch_row_batches(materials):
+        write_batch(session, """
+            UNWIND $rows AS r
+            MATCH (c:CADFile {file_id: r.file_id})
+            MERGE (m:Material {name: r.material_name})
+            SET m.standard = r.material_standard,
+                m.density = r.density
+            MERGE (c)-[:HAS_MATERIAL]->(m)
+        """, rows=rows)
+    conn.close()
+
+def run_in_own_session(ingest_fn):
+    # Sessions and SQLite connections must not be shared across threads
+    with driver.session(database=NEO4J_DATABASE) as session:
+        ingest_fn(session)
+
+def ingest_cad_data(session):
     print("Ingesting CAD data...")
     conn = get_db_connection('data/harvested_cad.db')
     
     # Ingest CAD Files
-    files = conn.execute("SELECT * FROM cad_files").fetchall()
-    with driver.session() as session:
-        for file in files:
-            session.run("""
-                MERGE (c:CADFile {file_id: $file_id})
-                SET c.file_name = $file_name,
-                    c.file_type = $file_type,
-                    c.part_number = $part_number,
-                    c.revision = $revision,
-                    c.file_size = $file_size_bytes,
-                    c.extraction_status = $extraction_status
-            """, dict(file))
-            
-    # Ingest Engineering Notes
-    notes = conn.execute("SELECT * FROM cad_engineering_notes").fetchall()
-    with driver.session() as session:
-        for note in notes:
-            session.run("""
-                MATCH (c:CADFile {file_id: $file_id})
-                CREATE (n:EngineeringNote {
-                    note_id: $id,
-                    note_type: $note_type,
-                    note_number: $note_code,
-                    content: $note_value
-                })
-                CREATE (c)-[:HAS_NOTE]->(n)
-            """, dict(note))
+    file_count = 0
+    files = conn.execute("""
+        SELECT file_id, file_name, file_type, part_number, revision, file_size_bytes, extraction_status
+        FROM cad_files
+    """)
+    for rows in fetch_row_batches(files):
+        file_count += len(rows)
+        write_batch(session, """
+            UNWIND $rows AS r
+            MERGE (c:CADFile {file_id: r.file_id})
+            SET c.file_name = r.file_name,
+                c.file_type = r.file_type,
+                c.part_number = r.part_number,
+                c.revision = r.revision,
+                c.file_size = r.file_size_bytes,
+                c.extraction_status = r.extraction_status
+        """, rows=rows)
+    conn.close()
             
-    # Ingest Material Properties
-    materials = conn.execute("SELECT * FROM cad_material_properties").fetchall()
-    with driver.session() as session:
-        for mat in materials:
-            session.run("""
-                MATCH (c:CADFile {file_id: $file_id})
-                MERGE (m:Material {name: $material_name})
-                SET m.standard = $material_standard,
-                    m.density = $density
-                MERGE (c)-[:HAS_MATERIAL]->(m)
-            """, dict(mat))
+    # Notes and materials only depend on the CAD files, not on each other,
+    # so load both tables concurrently once the files are in place.
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(run_in_own_session, fn) for fn in (ingest_cad_notes, ingest_cad_materials)]
+        for future in futures:
+            future.result()
             
-    conn.close()
-    print(f"Ingested {len(files)} CAD files.")
+    print(f"Ingested {file_count} CAD files.")
 
-def ingest_rds_data():
+def ingest_rds_data(session):
     print("Ingesting RDS data...")
     conn = get_db_connection('data/harvested_rds.db')
     
     # Ingest Documents
-    docs = conn.execute("SELECT * FROM rds_documents").fetchall()
-    with driver.session() as session:
-        for doc in docs:
-            # Generate embedding for the document title/summary
-            # Some titles might be None, handle that
-            title = doc['title'] if doc['title'] else ""
-            text_to_embed = f"{doc['standard_code']} {title}"
-            embedding = embeddings.embed_query(text_to_embed)
-            
-            session.run("""
-                MERGE (s:StandardDocument {doc_id: $doc_id})
-                SET s.standard_code = $standard_code,
-                    s.title = $title,
-                    s.total_pages = $total_pages,
-                    s.extraction_timestamp = $extraction_date,
-                    s.embedding = $embedding
-            """, {**dict(doc), "embedding": embedding})
+    doc_count = 0
+    docs = conn.execute("SELECT doc_id, standard_code, title, total_pages, extraction_date FROM rds_documents")
+    for rows in fetch_row_batches(docs):
+        doc_count += len(rows)
+
+        # Generate embeddings for the document title/summary
+        # Some titles might be None, handle that
+        texts = [f"{doc['standard_code']} {doc['title'] or ''}" for doc in rows]
+        vectors, scales = quantize_int8(embed_texts(texts))
+        for doc, embedding, scale in zip(rows, vectors, scales):
+            doc["standard_number"] = standard_number(doc["standard_code"])
+            doc["embedding"] = embedding
+            doc["embedding_scale"] = scale
+
+        write_batch(session, """
+            UNWIND $rows AS r
+            MERGE (s:StandardDocument {doc_id: r.doc_id})
+            SET s.standard_code = r.standard_code,
+                s.standard_number = r.standard_number,
+                s.title = r.title,
+                s.total_pages = r.total_pages,
+                s.extraction_timestamp = r.extraction_date,
+                s.embedding = r.embedding,
+                s.embedding_scale = r.embedding_scale
+        """, rows=rows)
             
     conn.close()
-    print(f"Ingested {len(docs)} RDS documents.")
+    print(f"Ingested {doc_count} RDS documents.")
+
+def link_with_apoc(session) -> int:
+    """Extract references and link them server-side with apoc.periodic.iterate."""
+    # Batches run serially: every batch merges into the same few StandardDocument
+    # nodes, so parallel batches would mostly contend for their locks.
+    res = session.run("""
+        CALL apoc.periodic.iterate(
+            "MATCH (n:EngineeringNote) WHERE n.content CONTAINS 'STD' RETURN n",
+            "WITH n, [g IN apoc.text.regexGroups(n.content, $pattern) | toInteger(g[1])] AS codes
+             UNWIND codes AS code
+             MATCH (s:StandardDocument {standard_number: code})
+             MERGE (n)-[:REFERENCES]->(s)",
+            {batchSize: 5000, parallel: false, retries: 3, params: {pattern: $pattern}}
+        )
+        YIELD failedOperations, errorMessages, updateStatistics
+        RETURN failedOperations, errorMessages, updateStatistics
+    """, pattern=_STD_RE.pattern).single()
+    count = res["updateStatistics"]["relationshipsCreated"]
+    if res["failedOperations"]:
+        # MERGE is idempotent, so the client-side pass only adds the missing links
+        print(f"{res['failedOperations']} APOC linking operations failed ({res['errorMessages']}), "
+              "retrying client-side...")
+        count += link_client_side(session)
+    return count
 
-def create_relationships():
+def link_client_side(session) -> int:
+    """Extract references in Python and link them in UNWIND batches."""
+    # Resolve standard numbers to documents in-process instead of per match in Cypher
+    std_map: Dict[int, List[str]] = {}
+    for record in session.run("MATCH (s:StandardDocument) RETURN s.standard_number AS number, s.doc_id AS id"):
+        std_map.setdefault(record["number"], []).append(record["id"])
+
+    # Read note text straight from SQLite as bytes; it is only scanned for
+    # ASCII references, so decoding every row to str would be wasted work.
+    conn = get_db_connection('data/harvested_cad.db')
+    conn.text_factory = bytes
+    notes = conn.execute("SELECT id, note_value FROM cad_engineering_notes WHERE note_value LIKE '%STD%'")
+    
+    # Look for patterns like "STD 1234" and collect the (note, document) edges
+    edges = [
+        {"nid": note_id, "did": doc_id}
+        for chunk in fetch_batches(notes)
+        for note_id, content in chunk
+        for match in _STD_RE_BYTES.finditer(content)
+        for doc_id in std_map.get(int(match.group(1)), ())
+    ]
+    conn.close()
+    
+    # Count relationships actually created, as the APOC path does; duplicate
+    # references and edges to notes that were never ingested add nothing.
+    count = 0
+    for chunk in batched(edges):
+        summary = write_batch(session, """
+            UNWIND $edges AS e
+            MATCH (n:EngineeringNote {note_id: e.nid})
+            MATCH (s:StandardDocument {doc_id: e.did})
+            MERGE (n)-[:REFERENCES]->(s)
+        """, edges=chunk)
+        count += summary.counters.relationships_created
+    return count
+
+def create_relationships(session):
     print("Creating relationships between Notes and Standards...")
-    with driver.session() as session:
-        # Fetch all notes
-        result = session.run("MATCH (n:EngineeringNote) RETURN n.note_id as id, n.content as content")
-        notes = list(result)
-        
-        count = 0
-        for note in notes:
-            content = note["content"]
-            # Look for patterns like "STD 1234"
-            matches = re.findall(r"STD\s?([0-9]+)", content)
-            
-            for code_num in matches:
-                # Construct query string to find matching standard
-                # We assume standard_code format in DB matches "STD <number>" or similar
-                # Using a loose match or exact match depending on data quality.
-                # Here we try to match the number part if the standard_code contains it.
-                
-                query = """
-                MATCH (n:EngineeringNote {note_id: $note_id})
-                MATCH (s:StandardDocument)
-                WHERE s.standard_code CONTAINS $code_num
-                MERGE (n)-[:REFERENCES]->(s)
-                RETURN count(s) as c
-                """
-                res = session.run(query, note_id=note["id"], code_num=code_num).single()
-                if res and res["c"] > 0:
-                    count += 1
+    try:
+        count = link_with_apoc(session)
+    except ClientError as e:
+        if e.code != "Neo.ClientError.Procedure.ProcedureNotFound":
+            raise
+        print("APOC not available, linking client-side...")
+        count = link_client_side(session)
                     
     print(f"Created {count} links between Notes and Standards.")
 
 def main():
     try:
-        setup_constraints()
-        clear_database()
-        ingest_cad_data()
-        ingest_rds_data()
-        create_relationships()
+        # One session for the whole run; each batch commits in its own write transaction
+        # fetch_size lets the standard_number map stream in large pages
+        with driver.session(database=NEO4J_DATABASE, fetch_size=10_000) as session:
+            drop_vector_index(session)
+            clear_database(session)
+            setup_constraints(session)
+            ingest_cad_data(session)
+            ingest_rds_data(session)
+            create_relationships(session)
+            finalize_indexes(session)
         print("Ingestion complete!")
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -8,6 +8,7 @@ load_dotenv()
 NEO4J_URI = os.getenv("NEO4J_URI")
 NEO4J_USERNAME = os.getenv("NEO4J_USERNAME")
 NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
+NEO4J_DATABASE = os.getenv("NEO4J_DATABASE", "neo4j")
 
 def verify():
     print("Verifying Setup...")
@@ -21,12 +22,13 @@ def verify():
         driver.verify_connectivity()
         print("SUCCESS: Connected to Neo4j.")
         
-        with driver.session() as session:
-            count = session.run("MATCH (n) RETURN count(n) as c").single()["c"]
-            print(f"SUCCESS: Found {count} nodes in the database.")
-            
-            links = session.run("MATCH ()-[r:REFERENCES]->() RETURN count(r) as c").single()["c"]
-            print(f"SUCCESS: Found {links} REFERENCES relationships.")
+        with driver.session(database=NEO4J_DATABASE) as session:
+            # Both counts are answered from Neo4j's count store in one round-trip
+            counts = session.run(
+                "RETURN COUNT { (n) } AS nodes, COUNT { ()-[:REFERENCES]->() } AS links"
+            ).single()
+            print(f"SUCCESS: Found {counts['nodes']} nodes in the database.")
+            print(f"SUCCESS: Found {counts['links']} REFERENCES relationships.")
             
         driver.close()
     except Exception as e: